@@ -2,13 +2,14 @@
 # Hayashi v0.7.1 — no auto render; safe "render visible (x2)" queue; per-page render buttons
 # PyQt5 + PyMuPDF
 
-import sys, io, re, collections, traceback, time
+import sys, io, traceback, time, threading, itertools, bisect
 from pathlib import Path
 from PyQt5 import QtCore, QtGui, QtWidgets
 import fitz
 import html as _html
 
 APP_NAME = "Hayashi"
+PAGE_CACHE_BYTES = 512*1024*1024  # total for both page caches; QImage and QPixmap get half each
 
 def _excepthook(exc_type, exc, tb):
     msg = "".join(traceback.format_exception(exc_type, exc, tb))
@@ -17,114 +18,287 @@ def _excepthook(exc_type, exc, tb):
     print(msg, file=sys.stderr)
 sys.excepthook = _excepthook
 
+_MISSING=object()
+
 class LRUCache:
-    def __init__(self, max_items=24): self.max=max_items; self.d=collections.OrderedDict()
+    # plain dicts keep insertion order; pop+reinsert moves a key to the MRU end.
+    # Locked because render workers share the cache with the GUI thread.
+    # With max_bytes, entries are also evicted until the summed `size` of put() fits the budget.
+    def __init__(self, max_items=24, max_bytes=None):
+        self.max=max_items; self.max_bytes=max_bytes; self.d={}; self.sizes={}; self.total_bytes=0
+        self.lock=threading.Lock()
     def get(self,k):
-        if k in self.d: v=self.d.pop(k); self.d[k]=v; return v
-        return None
-    def put(self,k,v):
-        if k in self.d: self.d.pop(k)
-        self.d[k]=v
-        while len(self.d)>self.max: self.d.popitem(last=False)
+        with self.lock:
+            v=self.d.pop(k,_MISSING)
+            if v is _MISSING: return None
+            self.d[k]=v; return v
+    def put(self,k,v,size=0):
+        with self.lock:
+            if self.d.pop(k,_MISSING) is not _MISSING: self.total_bytes-=self.sizes.pop(k)
+            self.d[k]=v; self.sizes[k]=size; self.total_bytes+=size
+            while len(self.d)>self.max or (self.max_bytes is not None and self.total_bytes>self.max_bytes and len(self.d)>1):
+                old=next(iter(self.d)); del self.d[old]; self.total_bytes-=self.sizes.pop(old)
+    def clear(self):
+        with self.lock: self.d.clear(); self.sizes.clear(); self.total_bytes=0
+
+_FAILED_TAG="hayashi-render-failed"  # QImage text key marking the "Render failed" tile
+
+_PIX_FORMATS={1:QtGui.QImage.Format_Grayscale8, 3:QtGui.QImage.Format_RGB888, 4:QtGui.QImage.Format_RGBA8888}
+
+def _qimage_from_pix(pix,fmt):
+    # copy MuPDF's buffer straight into a preallocated QImage (one memcpy); pix.samples
+    # would first copy into a bytes object, and QImage(...).copy() copies a second time
+    mv=getattr(pix,"samples_mv",None)
+    img=QtGui.QImage(pix.width,pix.height,fmt)
+    if mv is not None and img.bytesPerLine()==pix.stride:
+        ptr=img.bits(); ptr.setsize(img.sizeInBytes())
+        memoryview(ptr)[:]=mv
+        return img
+    return QtGui.QImage(pix.samples,pix.width,pix.height,pix.stride,fmt).copy()
+
+_BLOCK_FLAGS=fitz.TEXTFLAGS_BLOCKS|fitz.TEXT_PRESERVE_IMAGES
+
+def _join_parts(parts,page_marks,fig_marks):
+    # page_marks[i] is len(parts) when page i ended; fig_marks holds (part index, fig_id, pno)
+    # of each figure marker. One accumulate() pass turns those part indices into char offsets,
+    # instead of a running counter in the build loops.
+    pos=list(itertools.accumulate(map(len,parts),initial=0))
+    ends=[pos[m] for m in page_marks]
+    figure_spans=[(pos[i],pos[i+1],fid,pno) for i,fid,pno in fig_marks]
+    return "".join(parts).rstrip(), list(zip([0]+ends[:-1],ends)), figure_spans
+
+class _LoaderSignals(QtCore.QObject):
+    finished = QtCore.pyqtSignal(object)
+    failed = QtCore.pyqtSignal(str)
+
+class DocLoader(QtCore.QRunnable):
+    """Extracts the text off the GUI thread. Opens the PDF itself unless the open `doc` is passed in."""
+    def __init__(self, model, doc=None):
+        super().__init__(); self.model=model; self.doc=doc; self.signals=_LoaderSignals()
+    def run(self):
+        m=self.model; doc=self.doc
+        try:
+            if doc is None: doc=fitz.open(str(m.pdf_path))
+            build=m._build_simple if m.mode=="simple" else m._build_structured
+            merged,figures,offsets,figure_spans=build(doc)
+            self.signals.finished.emit((doc,merged,figures,offsets,figure_spans,len(doc)))
+        except Exception as e:
+            if doc is not None and doc is not self.doc: doc.close()
+            self.signals.failed.emit(str(e))
 
 class DocModel(QtCore.QObject):
     loaded = QtCore.pyqtSignal()
-    def __init__(self, pdf_path: Path, dpi=110, mode="simple", strip_headers=False, parent=None):
+    failed = QtCore.pyqtSignal(str)
+    def __init__(self, pdf_path: Path, dpi=110, mode="simple", strip_headers=False, defer_figures=True, parent=None):
         super().__init__(parent)
         self.pdf_path=Path(pdf_path); self.doc=None; self.page_count=0
         self.dpi=max(72,min(dpi,220)); self.mode=mode; self.strip_headers=strip_headers
+        self.dpr=1.0  # screen device pixel ratio, set by PdfView; scales the DPI cap for HiDPI
+        self.defer_figures=defer_figures  # simple mode: skip the per-page image enumeration
         self.merged_text=""; self.figures={}; self.page_offsets=[]
-        self.page_pix_cache=LRUCache(max_items=20)
+        self.figure_spans=[]  # (start, end, fig_id, pno) of each [FIGURE …] marker in merged_text
+        # max_items is only a backstop; the byte budget is what normally evicts
+        self.page_pix_cache=LRUCache(max_items=400, max_bytes=PAGE_CACHE_BYTES//2)  # QImage, filled from any thread
+        self.page_qpm_cache=LRUCache(max_items=400, max_bytes=PAGE_CACHE_BYTES//2)  # QPixmap, GUI thread only
+        self._loader=None; self._closed=threading.Event()
+        self._sleeping=None  # cancel event of the job throttling on render_pool, woken by close()
+        # all fitz work (open, text builds, rendering, prefetch) runs on this single thread:
+        # PyMuPDF isn't thread-safe even across separate Documents, so self.doc is never
+        # touched from two threads at once. Job priority: loader > page requests > render all > prefetch.
+        self.render_pool=QtCore.QThreadPool(self); self.render_pool.setMaxThreadCount(1); self.render_pool.setExpiryTimeout(-1)
     def open(self):
-        self.doc=fitz.open(str(self.pdf_path)); self.page_count=len(self.doc)
-        (self._build_simple if self.mode=="simple" else self._build_structured)()
+        """Load in the background; `loaded` or `failed` fires on the GUI thread."""
+        self._start_loader(None)
+    def build_text(self, mode=None, defer_figures=None):
+        """Re-extract the text from the already open document, in the background; emits `loaded`."""
+        if mode is not None: self.mode=mode
+        if defer_figures is not None: self.defer_figures=defer_figures
+        # the loader shares self.doc; it runs on render_pool, so never alongside a render
+        self._start_loader(self.doc)
+    def _start_loader(self, doc):
+        self._loader=DocLoader(self, doc)
+        self._loader.signals.finished.connect(self._on_loaded)
+        self._loader.signals.failed.connect(self._on_failed)
+        self.render_pool.start(self._loader, 3)
+    def _is_current_loader(self):
+        # a newer open()/build_text() supersedes any loader still in flight
+        return self._loader is not None and self.sender() is self._loader.signals
+    @QtCore.pyqtSlot(object)
+    def _on_loaded(self,result):
+        doc,merged,figures,offsets,figure_spans,count=result
+        if self._closed.is_set() or not self._is_current_loader():
+            if doc is not self.doc and not doc.is_closed: doc.close()
+            return
+        self._loader=None
+        self.doc=doc; self.merged_text=merged; self.figures=figures; self.page_offsets=offsets; self.figure_spans=figure_spans; self.page_count=count
         self.loaded.emit()
+    @QtCore.pyqtSlot(str)
+    def _on_failed(self,err):
+        if not self._is_current_loader(): return
+        doc=self._loader.doc; self._loader=None
+        if doc is not None and not self._closed.is_set(): self.doc=doc
+        self.failed.emit(err)
+    def set_dpi(self, dpi):
+        """Change the render DPI; drops rendered pages but keeps the document open."""
+        self.dpi=max(72,min(dpi,220))
+        self.page_pix_cache.clear(); self.page_qpm_cache.clear()
     def close(self):
+        # jobs and text builds check _closed, so the wait is at most about one page;
+        # a render-all job asleep on its own cancel event is woken too
+        self._closed.set()
+        sleeping=self._sleeping
+        if sleeping is not None: sleeping.set()
+        self.render_pool.clear(); self.render_pool.waitForDone()
         if self.doc: self.doc.close(); self.doc=None
-    def _build_simple(self):
-        parts=[]; char_count=0; fig_id=0
-        self.figures.clear(); self.page_offsets.clear()
-        for pno in range(self.page_count):
-            page=self.doc[pno]; start=char_count
+    def _build_simple(self,doc):
+        parts=[]; fig_id=0; figures={}; page_marks=[]; fig_marks=[]
+        for pno in range(len(doc)):
+            if self._closed.is_set(): break
+            page=doc[pno]
             txt=(page.get_text("text") or "").strip()
             if txt:
-                parts.append(txt); char_count+=len(txt); parts.append("\n\n"); char_count+=2
-            try: imgs=page.get_images(full=False)
-            except Exception: imgs=[]
+                parts.append(txt); parts.append("\n\n")
+            if self.defer_figures: imgs=()
+            else:
+                try: imgs=page.get_images(full=False)
+                except Exception: imgs=[]
             if imgs:
-                marks=[]
-                for info in imgs:
+                for i,info in enumerate(imgs):
                     xref=info[0]; fig_id+=1
-                    marks.append(f"[FIGURE {fig_id} (p{pno+1})]")
-                    self.figures[fig_id]={"page":pno,"xref":xref,"bbox":None}
-                m=" ".join(marks); parts.append(m); char_count+=len(m); parts.append("\n\n"); char_count+=2
-            self.page_offsets.append((start,char_count))
-        self.merged_text="".join(parts).rstrip()
-    def _build_structured(self):
-        parts=[]; char_count=0; fig_id=0
-        self.figures.clear(); self.page_offsets.clear()
-        for pno in range(self.page_count):
-            page=self.doc[pno]; start=char_count
-            raw=page.get_text("rawdict"); page_h=page.rect.height
-            top_cut=60 if self.strip_headers else -1e9; bot_cut=page_h-60 if self.strip_headers else 1e9
+                    if i: parts.append(" ")
+                    fig_marks.append((len(parts),fig_id,pno)); parts.append(f"[FIGURE {fig_id} (p{pno+1})]")
+                    figures[fig_id]={"page":pno,"xref":xref,"bbox":None}
+                parts.append("\n\n")
+            page_marks.append(len(parts))
+        merged,offsets,figure_spans=_join_parts(parts,page_marks,fig_marks)
+        return merged, figures, offsets, figure_spans
+    def _build_structured(self,doc):
+        parts=[]; fig_id=0; figures={}; page_marks=[]; fig_marks=[]; strip=self.strip_headers
+        for pno in range(len(doc)):
+            if self._closed.is_set(): break
+            page=doc[pno]
+            # "blocks" gives (x0,y0,x1,y1,text,block_no,block_type) tuples, far cheaper than "rawdict"
+            blocks=page.get_text("blocks", flags=_BLOCK_FLAGS)
+            if strip:
+                # drop text blocks lying wholly in the top/bottom 60pt band up front, so the
+                # common no-strip case runs the block loop without a per-block y-cut test
+                top_cut=60; bot_cut=page.rect.height-60
+                blocks=[b for b in blocks if b[6]!=0 or (b[3]>top_cut and b[1]<bot_cut)]
             wrote=False
-            for blk in raw.get("blocks",[]):
-                btype=blk.get("type",0)
-                if self.strip_headers and btype==0:
-                    y0,y1=blk.get("bbox",[0,0,0,0])[1], blk.get("bbox",[0,0,0,0])[3]
-                    if y1<=top_cut or y0>=bot_cut: continue
+            for (x0,y0,x1,y1,text,bno,btype) in blocks:
                 if btype==0:
-                    for line in blk.get("lines",[]):
-                        s="".join(sp.get("text","") for sp in line.get("spans",[]))
-                        if s.strip():
-                            parts.append(s); char_count+=len(s); parts.append("\n"); char_count+=1; wrote=True
-                    parts.append("\n"); char_count+=1
+                    if text and not text.isspace():
+                        parts.append(text.rstrip("\n")); parts.append("\n"); wrote=True
+                    parts.append("\n")
                 elif btype==1:
-                    xref=blk.get("xref") or blk.get("image")
-                    if xref:
-                        fig_id+=1; mark=f"[FIGURE {fig_id} (p{pno+1})]"
-                        parts.append(mark); char_count+=len(mark); parts.append("\n\n"); char_count+=2
-                        self.figures[fig_id]={"page":pno,"xref":xref,"bbox":tuple(blk.get("bbox",[0,0,0,0]))}
+                    # image blocks carry no xref; only "page" is used when a figure is clicked
+                    fig_id+=1; fig_marks.append((len(parts),fig_id,pno))
+                    parts.append(f"[FIGURE {fig_id} (p{pno+1})]"); parts.append("\n\n")
+                    figures[fig_id]={"page":pno,"xref":None,"bbox":(x0,y0,x1,y1)}
             if not wrote:
                 txt=(page.get_text("text") or "").strip()
-                if txt: parts.append(txt); char_count+=len(txt); parts.append("\n\n"); char_count+=2
-            self.page_offsets.append((start,char_count))
-        self.merged_text="".join(parts).rstrip()
-    def _page_key(self,pno,safe): return (pno,self.dpi,int(safe))
-    def render_page(self,pno,safe_png=True):
-        if self.doc is None or pno<0 or pno>=self.page_count: return None
-        key=self._page_key(pno,safe_png); cached=self.page_pix_cache.get(key)
+                if txt: parts.append(txt); parts.append("\n\n")
+            page_marks.append(len(parts))
+        merged,offsets,figure_spans=_join_parts(parts,page_marks,fig_marks)
+        return merged, figures, offsets, figure_spans
+    @staticmethod
+    def _width_bucket(width):
+        # round display widths up to 50 px so small resizes still hit the cache
+        return None if not width else -(-int(width)//50)*50
+    def _page_key(self,pno,safe,width=None): return (pno,self.dpi,int(safe),self._width_bucket(width))
+    def cached_pixmap(self,pno,safe_png=False,width=None):
+        return self.page_qpm_cache.get(self._page_key(pno,safe_png,width))
+    def page_pixmap(self,pno,img,safe_png=False,width=None,dpr=1.0):
+        """GUI thread only: `img` (rendered by the render thread) as a QPixmap, converted once and cached.
+        `dpr` is the screen's device pixel ratio; `width` is in device pixels."""
+        key=self._page_key(pno,safe_png,width); qpm=self.page_qpm_cache.get(key)
+        if qpm is not None: return qpm
+        if img is None: return None
+        qpm=QtGui.QPixmap.fromImage(img); qpm.setDevicePixelRatio(dpr)
+        if img.text(_FAILED_TAG): return qpm  # never cache the failure tile; the next request retries
+        self.page_qpm_cache.put(key,qpm,qpm.width()*qpm.height()*qpm.depth()//8); return qpm
+    def render_page(self,pno,safe_png=False,width=None):
+        """Rasterize page `pno`; call on render_pool only. With `width` (device px, zoom included) MuPDF
+        renders straight at that size, never above the DPI setting (per logical inch), instead of
+        rendering at DPI and rescaling afterwards."""
+        if self.doc is None or self._closed.is_set() or pno<0 or pno>=self.page_count: return None
+        key=self._page_key(pno,safe_png,width); cached=self.page_pix_cache.get(key)
         if cached is not None: return cached
         page=self.doc[pno]
         try:
-            scale=min(max(self.dpi/72.0,0.5),3.0); mat=fitz.Matrix(scale,scale)
+            scale=self.dpi/72.0*self.dpr
+            if width: scale=min(scale, self._width_bucket(width)/page.rect.width)
+            scale=min(max(scale,0.5),3.0*self.dpr); mat=fitz.Matrix(scale,scale)
             pix=page.get_pixmap(matrix=mat, alpha=False)
             if pix.width>6000 or pix.height>8000:
                 shrink=max(pix.width/3000.0, pix.height/4000.0)
                 mat2=fitz.Matrix(scale/shrink, scale/shrink)
                 pix=page.get_pixmap(matrix=mat2, alpha=False)
-            if safe_png:
-                data=pix.tobytes("png"); img=QtGui.QImage.fromData(data,"PNG").copy()
-                self.page_pix_cache.put(key,img); return img
-            if pix.n==1: fmt=QtGui.QImage.Format_Grayscale8
-            elif pix.n==3: fmt=QtGui.QImage.Format_RGB888
-            elif pix.n==4: fmt=QtGui.QImage.Format_RGBA8888
-            else:
+            fmt=_PIX_FORMATS.get(pix.n)
+            if safe_png or fmt is None:
+                # PNG round-trip is opt-in (or for odd channel counts); it costs a full encode+decode
                 data=pix.tobytes("png"); img=QtGui.QImage.fromData(data,"PNG").copy()
-                self.page_pix_cache.put(key,img); return img
-            img=QtGui.QImage(pix.samples,pix.width,pix.height,pix.stride,fmt).copy()
-            self.page_pix_cache.put(key,img); return img
+                self.page_pix_cache.put(key,img,img.sizeInBytes()); return img
+            img=_qimage_from_pix(pix,fmt)
+            self.page_pix_cache.put(key,img,img.sizeInBytes()); return img
         except Exception:
             tile=QtGui.QImage(320,200,QtGui.QImage.Format_RGB888); tile.fill(QtGui.QColor(40,40,40))
             p=QtGui.QPainter(tile); p.setPen(QtGui.QColor(255,200,0)); p.drawText(10,100,f"Render failed p{pno+1}"); p.end()
-            return tile
-
-class ZoomableLabel(QtWidgets.QLabel):
+            tile.setText(_FAILED_TAG,"1"); return tile
+
+class _RenderSignals(QtCore.QObject):
+    done = QtCore.pyqtSignal(int, object)
+
+class PageRenderJob(QtCore.QRunnable):
+    """Renders one page on the model's render thread; the result is posted back via `signals.done`.
+    Without `signals` it only warms the model's page cache (prefetch). Setting `cancel` drops the
+    job if it hasn't run yet. `delay_ms` may be a callable, read when the job starts, so a
+    Settings change applies to a render-all already in progress."""
+    def __init__(self, model, pno, safe_png, width=None, delay_ms=0, signals=None, cancel=None):
+        super().__init__(); self.model=model; self.pno=pno; self.safe_png=safe_png; self.width=width
+        self.delay_ms=delay_ms; self.signals=signals; self.cancel=cancel
+    def run(self):
+        m=self.model; cancel=self.cancel or m._closed
+        delay=self.delay_ms() if callable(self.delay_ms) else self.delay_ms
+        if delay:  # throttle, one page at a time
+            m._sleeping=cancel
+            try:
+                if m._closed.is_set() or cancel.wait(delay/1000.0): return
+            finally: m._sleeping=None
+        if cancel.is_set() or m._closed.is_set(): return
+        try: img=m.render_page(self.pno, safe_png=self.safe_png, width=self.width)
+        except Exception: img=None
+        if self.signals is not None: self.signals.done.emit(self.pno, img)
+
+class PageCanvas(QtWidgets.QGraphicsView):
+    """One page pixmap in a tiny scene; zoom is a view transform, so Qt scales at paint time."""
     def __init__(self, parent=None):
         super().__init__(parent)
+        scene = QtWidgets.QGraphicsScene(self); self.setScene(scene)
+        self.pix_item = scene.addPixmap(QtGui.QPixmap())
+        self.pix_item.setTransformationMode(QtCore.Qt.SmoothTransformation)
+        self.text_item = scene.addSimpleText(""); self.text_item.setBrush(QtGui.QColor("#aaa"))
         self.setAlignment(QtCore.Qt.AlignHCenter | QtCore.Qt.AlignTop)
-        self.setStyleSheet("QLabel { background:#222; color:#aaa; }")
-        self.setMinimumHeight(64)
+        self.setHorizontalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.setVerticalScrollBarPolicy(QtCore.Qt.ScrollBarAlwaysOff)
+        self.setFrameShape(QtWidgets.QFrame.NoFrame)
+        self.setBackgroundBrush(QtGui.QColor("#222"))
+        self.setFixedHeight(64)
+
+    def set_pixmap(self, qpm):
+        self.text_item.setText("")
+        self.pix_item.setPixmap(qpm)
+        self.setSceneRect(self.pix_item.boundingRect())
+
+    def clear_page(self, text=""):
+        self.pix_item.setPixmap(QtGui.QPixmap()); self.text_item.setText(text)
+        self.resetTransform(); self.setSceneRect(self.text_item.boundingRect())
+        self.setMinimumWidth(0); self.setFixedHeight(64)
+
+    def set_scale(self, z):
+        self.setTransform(QtGui.QTransform.fromScale(z, z))
+        r = self.pix_item.boundingRect()
+        self.setMinimumWidth(int(r.width() * z)); self.setFixedHeight(max(64, int(r.height() * z)))
 
     def wheelEvent(self, event):
         if event.modifiers() & QtCore.Qt.ShiftModifier:
@@ -142,7 +316,7 @@ class PageItem(QtWidgets.QFrame):
         super().__init__(); self.pdf_view=pdf_view; self.pno=pno
         self.setFrameShape(QtWidgets.QFrame.StyledPanel)
         lay=QtWidgets.QVBoxLayout(self); lay.setContentsMargins(6,6,6,6); lay.setSpacing(4)
-        self.img_label=ZoomableLabel(self)
+        self.canvas=PageCanvas(self)
         row=QtWidgets.QHBoxLayout()
         b_render=QtWidgets.QPushButton("Render"); b_render.clicked.connect(self._render_once)
         b_clear=QtWidgets.QPushButton("Clear"); b_clear.clicked.connect(self._clear)
@@ -152,46 +326,63 @@ class PageItem(QtWidgets.QFrame):
         info=QtWidgets.QLabel(f"p{pno+1}"); info.setStyleSheet("color:#888;")
         row.addWidget(b_render); row.addWidget(b_clear); row.addWidget(b_zoom_in); row.addWidget(b_zoom_out); row.addWidget(b_fit)
         row.addStretch(1); row.addWidget(info)
-        lay.addWidget(self.img_label); lay.addLayout(row)
-        self.original_img = None
+        lay.addWidget(self.canvas); lay.addLayout(row)
+        self.base_pix = None  # full-res QPixmap from DocModel.page_pixmap
+        self._raster_width = None  # device-px width base_pix was requested at
         self.zoom_factor = 1.0
+        # coalesce bursts of wheel/button zoom into a single relayout
+        self._zoom_timer = QtCore.QTimer(self)
+        self._zoom_timer.setSingleShot(True); self._zoom_timer.setInterval(50)
+        self._zoom_timer.timeout.connect(self.update_display)
+
+    def set_pixmap(self, qpm, raster_width=None):
+        self.base_pix = qpm; self._raster_width = raster_width
+        if qpm:
+            self.canvas.set_pixmap(qpm)
+            self.update_display()
 
     def _clear(self):
-        self.img_label.setPixmap(QtGui.QPixmap()); self.img_label.setText("Text-only mode"); self.img_label.setMinimumHeight(64)
-        self.original_img = None
+        self.canvas.clear_page("Text-only mode")
+        self.set_pixmap(None)
         self.zoom_factor = 1.0
 
     def _render_once(self):
-        self.original_img = self.pdf_view.render_single_page_raw(self.pno)
-        if self.original_img:
-            self.update_display()
+        self.pdf_view.request_page(self.pno)
 
     def update_display(self):
-        if not self.original_img:
+        if not self.base_pix:
             return
-        w = max(100, self.pdf_view.viewport().width() - 18 - 12)
+        w = self.pdf_view.target_px_width()
         scaled_width = int(w * self.zoom_factor)
-        qpm = QtGui.QPixmap.fromImage(self.original_img).scaledToWidth(scaled_width, QtCore.Qt.SmoothTransformation)
-        self.img_label.setPixmap(qpm)
-        self.img_label.setMinimumHeight(qpm.height())
-        self.img_label.setText("")
+        self.canvas.set_scale(scaled_width * self.base_pix.devicePixelRatio() / self.base_pix.width())
+        # zoomed past the current raster: fetch a sharper one (render_page still caps it at the DPI setting)
+        need = self.pdf_view.raster_width(self.zoom_factor)
+        if self._raster_width and DocModel._width_bucket(need) > DocModel._width_bucket(self._raster_width):
+            self.pdf_view.request_page(self.pno)
 
     def zoom_in(self):
         self.zoom_factor = min(3.0, self.zoom_factor + 0.1)
-        self.update_display()
+        self._zoom_timer.start()
 
     def zoom_out(self):
         self.zoom_factor = max(0.5, self.zoom_factor - 0.1)
-        self.update_display()
+        self._zoom_timer.start()
 
     def zoom_fit(self):
         self.zoom_factor = 1.0
         self.update_display()
 
+class PagePlaceholder(QtWidgets.QWidget):
+    """Empty stand-in for a PageItem until the page scrolls near the viewport."""
+    base_pix = None
+    def __init__(self, pno, height):
+        super().__init__(); self.pno = pno
+        self.setFixedHeight(height)
+
 class PdfView(QtWidgets.QScrollArea):
     def __init__(self,parent=None):
         super().__init__(parent)
-        self.model=None; self.safe_png=True
+        self.model=None; self.safe_png=False
         self.render_delay_ms = 100  # Default delay in milliseconds
         self.dpi = 110  # Default DPI
         self.setWidgetResizable(True)
@@ -199,51 +390,120 @@ class PdfView(QtWidgets.QScrollArea):
         self.vbox=QtWidgets.QVBoxLayout(self.container); self.vbox.setContentsMargins(0,0,0,0); self.vbox.setSpacing(12)
         self.setWidget(self.container)
         self.page_items=[]
-
-        # --- new: non-blocking "render all" scheduler ---
-        self._all_timer = QtCore.QTimer(self)
-        self._all_timer.timeout.connect(self._render_all_step)
-        self._all_idx = 0
+        # prefix sums of page heights for _visible_range; rebuilt after the container relayouts
+        self._y_offsets=None
+        self.container.installEventFilter(self)
+
+        # --- single-page requests are rendered on the model's render thread ---
+        self._page_signals = None
+        self._page_cancel = threading.Event()
+        self._requested = {}  # pno -> (width, safe_png), in flight
+
+        # --- "render all" runs on the model's thread pool ---
+        self._all_signals = None
+        self._all_pending = 0
+        self._all_width = None
+        self._all_safe = False
+        self._all_cancel = threading.Event()
         self._all_active = False
 
+        # render-ahead: once scrolling settles, warm the cache for visible pages +/- 2
+        self._prefetch_timer = QtCore.QTimer(self)
+        self._prefetch_timer.setSingleShot(True); self._prefetch_timer.setInterval(80)
+        self._prefetch_timer.timeout.connect(self._prefetch)
+        self._prefetch_cancel = threading.Event()
+
     def set_safe_png(self,on:bool): self.safe_png=bool(on)
 
     def set_render_delay(self, delay_ms):
         self.render_delay_ms = max(0, min(1000, delay_ms))  # Constrain between 0 and 1000ms
-        if self._all_timer.isActive():
-            self._all_timer.setInterval(self.render_delay_ms)
 
     def set_dpi(self, dpi):
         self.dpi = max(72, min(220, dpi))
 
     def set_model(self,model:DocModel):
         # stop any in-flight "render all"
-        if self._all_timer.isActive():
-            self._all_timer.stop(); self._all_active = False
-            QtWidgets.QApplication.restoreOverrideCursor()
+        self._stop_render_all()
 
         for i in reversed(range(self.vbox.count())):
             w=self.vbox.itemAt(i).widget()
             if w: w.setParent(None)
-        self.page_items.clear(); self.model=model
+        self.page_items.clear(); self.model=model; self._y_offsets=None
+        if model: model.dpr=self.devicePixelRatioF()
+        self._requested.clear(); self._page_cancel.set(); self._page_cancel=threading.Event()
+        self._prefetch_cancel.set(); self._prefetch_cancel=threading.Event()
+        self._page_signals=_RenderSignals(); self._page_signals.done.connect(self._on_page_ready)
         if not model:
             p=QtWidgets.QLabel("Open a PDF (File → Open…)"); p.setAlignment(QtCore.Qt.AlignCenter); p.setStyleSheet("color:#888; font-size:14px;")
             self.vbox.addWidget(p); self.vbox.addStretch(1); return
+        # only page 1 is a real PageItem; the rest are placeholders of the same height, so
+        # swapping them in via _page_item() doesn't shift the layout
+        h=None
         for pno in range(model.page_count):
-            item=PageItem(self,pno); self.vbox.addWidget(item); self.page_items.append(item)
+            if h is None: item=PageItem(self,pno); h=item.sizeHint().height()
+            else: item=PagePlaceholder(pno,h)
+            self.vbox.addWidget(item); self.page_items.append(item)
         self.vbox.addStretch(1)
+        QtCore.QTimer.singleShot(0, self._materialize_visible)
+
+    def _page_item(self, pno):
+        """The PageItem for `pno`, created in place of its placeholder on first use."""
+        item=self.page_items[pno]
+        if isinstance(item, PageItem): return item
+        real=PageItem(self,pno)
+        self.vbox.replaceWidget(item, real); item.deleteLater()
+        self.page_items[pno]=real
+        return real
+
+    def _materialize_visible(self):
+        if not self.model: return
+        start,end=self._visible_range()
+        for pno in range(start, end+1): self._page_item(pno)
+
+    def eventFilter(self, obj, ev):
+        if obj is self.container and ev.type() in (QtCore.QEvent.Resize, QtCore.QEvent.LayoutRequest):
+            self._y_offsets=None  # some page changed height
+        return super().eventFilter(obj, ev)
 
     def _visible_range(self):
         if not self.page_items: return (0,-1)
-        vp=self.viewport().rect()
-        top=self.viewport().mapTo(self.container, vp.topLeft()).y()
-        bot=self.viewport().mapTo(self.container, vp.bottomLeft()).y()
-        rng=[]; y=0; spacing=self.vbox.spacing()
-        for i,item in enumerate(self.page_items):
-            h=item.height() or 120
-            if y+h>=top-300 and y<=bot+300: rng.append(i)
-            y+=h+spacing
-        return (min(rng),max(rng)) if rng else (0,0)
+        # container is the viewport's child, so go through the scroll bar, not viewport().mapTo()
+        top=self.verticalScrollBar().value(); bot=top+self.viewport().height()
+        if self._y_offsets is None:
+            spacing=self.vbox.spacing()
+            self._y_offsets=list(itertools.accumulate(((item.height() or 120)+spacing for item in self.page_items), initial=0))
+        offs=self._y_offsets; last=len(self.page_items)-1
+        i0=max(0, bisect.bisect_right(offs, top-300)-1)
+        i1=min(last, bisect.bisect_right(offs, bot+300)-1)
+        return (i0,i1) if i0<=i1 else (0,0)
+
+    def target_px_width(self):
+        """Width a page is shown at when zoom is 1.0 (viewport minus scrollbar and frame margins)."""
+        return max(100, self.viewport().width() - 18 - 12)
+
+    def raster_width(self, zoom=1.0):
+        """Device-pixel width to rasterize a page at for `zoom`, so HiDPI screens get full resolution."""
+        return int(self.target_px_width() * zoom * self.devicePixelRatioF())
+
+    def scrollContentsBy(self, dx, dy):
+        super().scrollContentsBy(dx, dy)
+        self._materialize_visible()
+        self._prefetch_timer.start()
+
+    def resizeEvent(self, ev):
+        super().resizeEvent(ev)
+        self._materialize_visible()
+        self._prefetch_timer.start()
+
+    def _prefetch(self):
+        if not self.model: return
+        start,end=self._visible_range()
+        # drop stale requests from earlier scroll positions
+        self._prefetch_cancel.set(); self._prefetch_cancel=threading.Event()
+        for pno in range(max(0,start-2), min(len(self.page_items),end+3)):
+            if self.page_items[pno].base_pix is None:
+                self.model.render_pool.start(PageRenderJob(self.model, pno, self.safe_png, self.raster_width(),
+                                                           cancel=self._prefetch_cancel), 0)
 
     def render_visible_lite(self, count=2):
         """Render at most `count` visible pages (safe queue)."""
@@ -251,49 +511,73 @@ class PdfView(QtWidgets.QScrollArea):
         start,end=self._visible_range()
         done=0
         for pno in range(start, end+1):
-            item=self.page_items[pno]
-            if item.original_img is None:
-                item.original_img = self.render_single_page_raw(pno)
-                if item.original_img:
-                    item.update_display()
+            if self.page_items[pno].base_pix is None:
+                self.request_page(pno)
                 done+=1
                 if done>=count: break
 
-    def render_single_page_raw(self,pno:int):
-        if not self.model: return None
-        try:
-            return self.model.render_page(pno, safe_png=self.safe_png)
-        except Exception:
-            return None
+    def request_page(self, pno):
+        """Show page `pno`: straight from the pixmap cache, otherwise rendered (and PNG-decoded)
+        on the model's render thread and shown when the queued result arrives."""
+        if not self.model: return
+        item=self.page_items[pno]
+        width=self.raster_width(item.zoom_factor if isinstance(item, PageItem) else 1.0)
+        qpm=self.model.cached_pixmap(pno, self.safe_png, width)
+        if qpm is not None:
+            self._page_item(pno).set_pixmap(qpm, width); return
+        if pno in self._requested: return
+        self._requested[pno]=(width, self.safe_png)
+        self.model.render_pool.start(PageRenderJob(self.model, pno, self.safe_png, width=width,
+                                                   signals=self._page_signals, cancel=self._page_cancel), 2)
+
+    @QtCore.pyqtSlot(int, object)
+    def _on_page_ready(self, pno, img):
+        if self.sender() is not self._page_signals: return
+        width,safe=self._requested.pop(pno, (None, self.safe_png))
+        if img:
+            qpm=self.model.page_pixmap(pno, img, safe_png=safe, width=width, dpr=self.devicePixelRatioF())
+            self._page_item(pno).set_pixmap(qpm, width)
 
     def jump_to_page(self,pno):
         if not self.page_items or pno<0 or pno>=len(self.page_items): return
         self.verticalScrollBar().setValue(self.page_items[pno].pos().y())
 
-    # -------- new non-blocking "render all" ----------
+    # -------- non-blocking "render all" ----------
     def render_all_pages(self):
-        """Render all pages non-blockingly, one per timer tick."""
+        """Render all pages on the model's render thread, one per `render_delay_ms`; results arrive via queued signal."""
         if not self.model or self._all_active: return
-        self._all_idx = 0
+        pending = [item.pno for item in self.page_items if item.base_pix is None]
+        if not pending: return
         self._all_active = True
+        self._all_pending = len(pending)
+        self._all_width = self.raster_width()
+        self._all_safe = self.safe_png
+        self._all_cancel = threading.Event()
+        self._all_signals = _RenderSignals()
+        self._all_signals.done.connect(self._on_page_rendered)
         QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-        self._all_timer.setInterval(self.render_delay_ms)
-        self._all_timer.start()
-
-    def _render_all_step(self):
-        if not self.model or self._all_idx >= self.model.page_count:
-            self._all_timer.stop()
-            self._all_active = False
-            QtWidgets.QApplication.restoreOverrideCursor()
-            return
-        pno = self._all_idx
-        item = self.page_items[pno]
-        if item.original_img is None:
-            img = self.render_single_page_raw(pno)
-            if img:
-                item.original_img = img
-                item.update_display()
-        self._all_idx += 1
+        delay = lambda: self.render_delay_ms
+        for pno in pending:
+            self.model.render_pool.start(PageRenderJob(self.model, pno, self._all_safe, width=self._all_width, delay_ms=delay,
+                                                       signals=self._all_signals, cancel=self._all_cancel), 1)
+
+    def _stop_render_all(self):
+        if not self._all_active: return
+        self._all_active = False
+        self._all_cancel.set()
+        self._all_signals = None
+        QtWidgets.QApplication.restoreOverrideCursor()
+
+    @QtCore.pyqtSlot(int, object)
+    def _on_page_rendered(self, pno, img):
+        if self.sender() is not self._all_signals: return
+        if img and self.page_items[pno].base_pix is None:
+            # QPixmap must be created here on the GUI thread, not in the worker
+            qpm = self.model.page_pixmap(pno, img, safe_png=self._all_safe, width=self._all_width, dpr=self.devicePixelRatioF())
+            self._page_item(pno).set_pixmap(qpm, self._all_width)
+        self._all_pending -= 1
+        if self._all_pending <= 0:
+            self._stop_render_all()
 
 class SettingsDialog(QtWidgets.QDialog):
     def __init__(self, main_window, parent=None):
@@ -341,9 +625,11 @@ class TextView(QtWidgets.QTextEdit):
     def set_model(self,model:DocModel):
         self.model=model
         if not model: self.setPlainText(""); return
-        text=model.merged_text
-        def repl(m): return f'<a href="fig:{m.group(1)}">[FIGURE {m.group(1)} (p{m.group(2)})]</a>'
-        safe=_html.escape(text); html=re.sub(r'\[FIGURE\s+(\d+)\s+\(p(\d+)\)\]', repl, safe)
+        # splice anchors in at the marker spans recorded by the build; escape only the text between
+        text=model.merged_text; out=[]; cur=0
+        for start,end,fid,_pno in model.figure_spans:
+            out.append(_html.escape(text[cur:start])); out.append(f'<a href="fig:{fid}">{text[start:end]}</a>'); cur=end
+        out.append(_html.escape(text[cur:])); html="".join(out)
         self.setHtml(f"<html><body style='white-space:pre-wrap;font-family:Consolas,monospace;font-size:11pt'>{html}</body></html>")
     def mousePressEvent(self,ev:QtGui.QMouseEvent):
         if ev.button()==QtCore.Qt.LeftButton:
@@ -361,7 +647,7 @@ class MainWindow(QtWidgets.QMainWindow):
         self.splitter.addWidget(self.pdf_view); self.splitter.addWidget(self.text_view)
         self.splitter.setStretchFactor(0,3); self.splitter.setStretchFactor(1,2)
         self.setCentralWidget(self.splitter)
-        self.status=self.statusBar(); self.status.showMessage("Ready."); self.model=None
+        self.status=self.statusBar(); self.status.showMessage("Ready."); self.model=None; self._loading=False
 
         file_menu=self.menuBar().addMenu("&File")
         act_open=file_menu.addAction("Open PDF…"); act_open.setShortcut("Ctrl+O"); act_open.triggered.connect(self.open_pdf_dialog)
@@ -375,7 +661,7 @@ class MainWindow(QtWidgets.QMainWindow):
         act_render_all.triggered.connect(self.pdf_view.render_all_pages)
         view_menu.addSeparator()
         self.act_safe=view_menu.addAction("Render via PNG decoder (safer)")
-        self.act_safe.setCheckable(True); self.act_safe.setChecked(True)
+        self.act_safe.setCheckable(True); self.act_safe.setChecked(False)
         self.act_safe.toggled.connect(lambda on: self.pdf_view.set_safe_png(on))
         act_settings = view_menu.addAction("Settings")
         act_settings.triggered.connect(self.show_settings)
@@ -387,6 +673,9 @@ class MainWindow(QtWidgets.QMainWindow):
         grp=QtWidgets.QActionGroup(self); grp.addAction(self.act_simple); grp.addAction(self.act_struct); grp.setExclusive(True)
         self.act_simple.triggered.connect(lambda: self.rebuild_text(mode="simple"))
         self.act_struct.triggered.connect(lambda: self.rebuild_text(mode="structured"))
+        extract_menu.addSeparator()
+        self.act_figs=extract_menu.addAction("Figure markers in simple mode (slower)"); self.act_figs.setCheckable(True)
+        self.act_figs.toggled.connect(lambda on: self.rebuild_text(mode="simple") if self.act_simple.isChecked() else None)
 
         self.text_view.anchorClickedFigure.connect(self.on_anchor_clicked)
 
@@ -397,45 +686,70 @@ class MainWindow(QtWidgets.QMainWindow):
         dlg = SettingsDialog(self, self)
         dlg.exec_()
 
+    def closeEvent(self, ev):
+        # drain the render thread before Qt/Python teardown, or a late signal hits dead objects
+        self.pdf_view._stop_render_all()
+        if self.model: self.model.close()
+        ev.accept()
+
     def open_pdf_dialog(self):
         fn,_=QtWidgets.QFileDialog.getOpenFileName(self,"Open PDF",str(Path.home()),"PDF files (*.pdf)")
         if fn: self.load_pdf(Path(fn))
 
     def load_pdf(self,pdf_path:Path):
-        try:
-            self.status.showMessage(f"Opening {pdf_path} …"); QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
-            if self.model: self.model.close()
-            mode="structured" if self.act_struct.isChecked() else "simple"
-            self.model=DocModel(pdf_path, dpi=self.pdf_view.dpi, mode=mode)
-            self.model.open()
-            self.setWindowTitle(f"{APP_NAME} — {pdf_path.name}")
-            self.pdf_view.set_model(self.model); self.text_view.set_model(self.model)
-            self.pdf_view.set_safe_png(self.act_safe.isChecked())
-            self.status.showMessage(f"Loaded {self.model.page_count} pages.")
-        except Exception as e:
-            QtWidgets.QMessageBox.critical(self, APP_NAME, f"Failed to open:\n{pdf_path}\n\n{e}")
-        finally:
-            QtWidgets.QApplication.restoreOverrideCursor()
+        self.status.showMessage(f"Opening {pdf_path} …")
+        if self.model: self.model.close()
+        mode="structured" if self.act_struct.isChecked() else "simple"
+        self._start_model(self._new_model(pdf_path, mode))
+
+    def _new_model(self, pdf_path:Path, mode:str):
+        return DocModel(pdf_path, dpi=self.pdf_view.dpi, mode=mode, defer_figures=not self.act_figs.isChecked())
+
+    def _start_model(self, model):
+        # extraction runs on a worker; views are wired up once `loaded` arrives
+        self._begin_loading()
+        self.model=model
+        model.loaded.connect(self._on_model_loaded); model.failed.connect(self._on_model_failed)
+        model.open()
+
+    def _begin_loading(self):
+        if not self._loading:
+            QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor); self._loading=True
+
+    def _finish_loading(self):
+        if self._loading:
+            QtWidgets.QApplication.restoreOverrideCursor(); self._loading=False
+
+    @QtCore.pyqtSlot()
+    def _on_model_loaded(self):
+        model=self.sender()
+        if model is not self.model: return
+        self._finish_loading()
+        self.setWindowTitle(f"{APP_NAME} — {model.pdf_path.name}")
+        if self.pdf_view.model is not model: self.pdf_view.set_model(model)  # text rebuilds keep rendered pages
+        self.text_view.set_model(model)
+        self.pdf_view.set_safe_png(self.act_safe.isChecked())
+        self.status.showMessage(f"Loaded {model.page_count} pages.")
+
+    @QtCore.pyqtSlot(str)
+    def _on_model_failed(self, err:str):
+        model=self.sender()
+        if model is not self.model: return
+        self._finish_loading(); model.close(); self.model=None
+        self.pdf_view.set_model(None); self.text_view.set_model(None)
+        self.status.showMessage("Ready.")
+        QtWidgets.QMessageBox.critical(self, APP_NAME, f"Failed to open:\n{model.pdf_path}\n\n{err}")
 
     def rebuild_text(self, mode:str):
+        # re-extracts from the open document; no fitz.open round trip
         if not self.model: return
-        p=self.model.pdf_path; safe=self.act_safe.isChecked()
-        self.model.close(); self.model=DocModel(p, dpi=self.pdf_view.dpi, mode=mode)
-        self.model.open()
-        self.pdf_view.set_model(self.model); self.text_view.set_model(self.model)
-        self.pdf_view.set_safe_png(safe)
+        self._begin_loading()
+        self.model.build_text(mode, defer_figures=not self.act_figs.isChecked())
 
     def reload_pdf_with_new_dpi(self):
         if not self.model: return
-        p = self.model.pdf_path
-        mode = "structured" if self.act_struct.isChecked() else "simple"
-        safe = self.act_safe.isChecked()
-        self.model.close()
-        self.model = DocModel(p, dpi=self.pdf_view.dpi, mode=mode)
-        self.model.open()
-        self.pdf_view.set_model(self.model)
-        self.text_view.set_model(self.model)
-        self.pdf_view.set_safe_png(safe)
+        self.model.set_dpi(self.pdf_view.dpi)
+        if self.pdf_view.model is self.model: self.pdf_view.set_model(self.model)  # drop pages rendered at the old DPI
 
     @QtCore.pyqtSlot(int)
     def on_anchor_clicked(self, fig_id:int):